@@ -1,13 +1,18 @@
+import hashlib
 import json
 import os
 import re
 import sys
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import webview
-from flask import Flask, request, jsonify, render_template
+import numpy as np
+import orjson
+from flask import Flask, request, render_template
 from huggingface_hub import InferenceClient
 from huggingface_hub.errors import HfHubHTTPError
-from math import radians, sin, cos, sqrt, atan2
+from math import radians, cos
 
 # --- 輔助函式：處理打包後的路徑 ---
 def resource_path(relative_path):
@@ -25,23 +30,177 @@ app = Flask(__name__, template_folder=template_folder)
 API_TOKEN = ""  # 請確保這是您有效的 Hugging Face Token
 AI_MODEL = "google/gemma-2-9b-it"
 DATA_FILE = resource_path('data.json')
+CRITERIA_CACHE_FILE = os.path.expanduser('~/.cache/house_ai_criteria.json')
+CRITERIA_CACHE_TTL = 7 * 24 * 60 * 60  # AI 解析結果保留 7 天
+CRITERIA_CACHE_SIZE = 1024
+SERVER_THREADS = 32  # waitress 工作執行緒數量，AI 呼叫會佔住執行緒數秒
+AI_WORKERS = 8       # 同時進行中的 AI 呼叫上限，須小於 SERVER_THREADS，其餘請求排隊等候
+MAX_MESSAGE_LENGTH = 512  # 使用者需求的字數上限，避免過長的輸入拖慢 AI 推論
 
 # --- 載入房屋資料 ---
 try:
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        house_data = json.load(f)
+    with open(DATA_FILE, 'rb') as f:
+        house_data = orjson.loads(f.read())
     print(f"✅ 成功載入 {len(house_data)} 筆房屋資料。")
 except FileNotFoundError:
     print(f"🔴 錯誤: 找不到資料檔案 {DATA_FILE}")
     house_data = []
-except json.JSONDecodeError:
+except orjson.JSONDecodeError:
     print(f"🔴 錯誤: {DATA_FILE} 格式不正確。")
     house_data = []
+if not isinstance(house_data, list):
+    print(f"🔴 錯誤: {DATA_FILE} 格式不正確。")
+    house_data = []
+
+# --- 檢查欄位式資料需要的欄位 ---
+HOUSE_NUMERIC_FIELDS = ('latitude', 'longitude', 'price', 'age', 'size')
+
+def is_valid_house(house) -> bool:
+    """建立 NumPy 欄位需要的欄位都必須是數字（price 需在 int32 範圍內），標籤必須是字串串列"""
+    if not isinstance(house, dict):
+        return False
+    for field in HOUSE_NUMERIC_FIELDS:
+        value = house.get(field)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+    if not -2**31 <= house['price'] < 2**31:
+        return False
+    labels = house.get('label', [])
+    return isinstance(labels, list) and all(isinstance(lbl, str) for lbl in labels)
+
+invalid_rows = [i for i, h in enumerate(house_data) if not is_valid_house(h)]
+if invalid_rows:
+    print(f"🔴 略過 {len(invalid_rows)} 筆欄位缺漏或格式不正確的房屋資料（第 {', '.join(str(i + 1) for i in invalid_rows)} 筆）")
+    house_data = [h for h in house_data if is_valid_house(h)]
+
+# --- 建立欄位式資料 ---
+# 篩選只讀取以下連續的 NumPy 欄位；house_data 僅用於最後輸出房屋資訊
+# 以公里為單位的距離篩選，float32 的精度已足夠，並可減少一半的記憶體頻寬
+house_lat = np.asarray([h['latitude'] for h in house_data], dtype=np.float32)
+house_lon = np.asarray([h['longitude'] for h in house_data], dtype=np.float32)
+house_price = np.asarray([h['price'] for h in house_data], dtype=np.int32)  # 新台幣，上限約 21 億
+house_age = np.asarray([h['age'] for h in house_data], dtype=np.int32)
+house_size = np.asarray([h['size'] for h in house_data], dtype=np.float32)  # 坪數可能有小數
+
+# 房屋端的弧度與 cos(緯度) 固定不變，載入時算一次即可
+_house_lat_rad = np.radians(house_lat)
+_house_lon_rad = np.radians(house_lon)
+_house_coslat = np.cos(_house_lat_rad)
+# 依緯度排序的索引，作為距離篩選用的一維空間索引
+_lat_order = np.argsort(_house_lat_rad, kind='stable')
+_sorted_lat_rad = _house_lat_rad[_lat_order]
+
+# 標籤轉為布林矩陣 [房屋數, 標籤數]，篩選時只需對欄位做 any/all
+# 每間房屋的標籤只在載入時轉成 frozenset 一次，之後建索引與矩陣都重複使用
+house_labels = [frozenset(h.get('label', ())) for h in house_data]
+label_index = {lbl: i for i, lbl in enumerate(sorted(frozenset().union(*house_labels)))}
+house_label_matrix = np.zeros((len(house_data), len(label_index)), dtype=bool)
+for row, labels in enumerate(house_labels):
+    house_label_matrix[row, [label_index[lbl] for lbl in labels]] = True
+
+
+# --- 載入 AI 解析結果快取 ---
+def is_valid_cache_entry(entry) -> bool:
+    """快取項目必須是 {'time': 數字, 'criteria': dict}"""
+    return (isinstance(entry, dict)
+            and isinstance(entry.get('time'), (int, float))
+            and isinstance(entry.get('criteria'), dict))
+
+try:
+    with open(CRITERIA_CACHE_FILE, 'r', encoding='utf-8') as f:
+        criteria_cache = json.load(f)
+except (OSError, ValueError):
+    # 檔案不存在、無法讀取或不是合法的 JSON
+    criteria_cache = {}
+if not (isinstance(criteria_cache, dict) and all(map(is_valid_cache_entry, criteria_cache.values()))):
+    print(f"🔴 快取檔案 {CRITERIA_CACHE_FILE} 格式不正確，將重新建立。")
+    criteria_cache = {}
+criteria_cache_lock = threading.Lock()
+criteria_cache_file_lock = threading.Lock()  # 依序寫入快取檔案，較晚的快照一定較晚寫入
+
+# AI 呼叫由獨立的執行緒池處理（最多 AI_WORKERS 個同時進行），並共用同一個 client
+ai_client = InferenceClient(model=AI_MODEL, token=API_TOKEN)
+ai_executor = ThreadPoolExecutor(max_workers=AI_WORKERS, thread_name_prefix='ai')
+ai_inflight = {}  # 進行中的 AI 呼叫，key 與快取相同
+ai_inflight_lock = threading.Lock()
+
+# 將控制字元（換行、Tab 等）換成空白，避免干擾送給 AI 的提示詞
+CONTROL_CHARS = dict.fromkeys([*range(32), 127], ' ')
+
+# SQL-like 條件，例如 "price <= 24000000"；為了安全，只允許簡單的比較
+SQL_CONDITION_RE = re.compile(r'^\w+\s*([<>=!]+)\s*([\d\.]+)$')
+SQL_OPERATORS = {
+    '<=': np.less_equal,
+    '>=': np.greater_equal,
+    '<': np.less,
+    '>': np.greater,
+    '=': np.equal,
+    '!=': np.not_equal,
+}
 
 
 # --- 輔助函式 ---
 
 def get_ai_criteria(user_requirement: str) -> dict:
+    """取得使用者需求對應的篩選條件，相同需求優先使用快取，避免重複呼叫 AI"""
+    key = hashlib.sha256((user_requirement + AI_MODEL).encode('utf-8')).hexdigest()
+    cached = lookup_ai_criteria(key)
+    if cached is not None:
+        return cached
+
+    # 相同需求若已有進行中的 AI 呼叫，直接等待同一個結果，不重複發送
+    with ai_inflight_lock:
+        # 持有鎖時再查一次快取：負責呼叫的請求會先寫入快取才移除 ai_inflight，
+        # 兩次查詢之間若剛好完成，這裡就會命中，不會重複呼叫 AI
+        cached = lookup_ai_criteria(key)
+        if cached is not None:
+            return cached
+        future = ai_inflight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = ai_executor.submit(request_ai_criteria, user_requirement)
+            ai_inflight[key] = future
+    try:
+        criteria = future.result()
+        if is_owner and criteria:  # 失敗的結果不快取，下次再重試
+            store_ai_criteria(key, criteria)
+    finally:
+        if is_owner:
+            with ai_inflight_lock:
+                ai_inflight.pop(key, None)
+    return dict(criteria)
+
+def lookup_ai_criteria(key: str):
+    """查詢快取中未過期的 AI 解析結果，沒有則回傳 None"""
+    with criteria_cache_lock:
+        entry = criteria_cache.pop(key, None)
+        if entry and time.time() - entry['time'] < CRITERIA_CACHE_TTL:
+            criteria_cache[key] = entry  # 重新放到最後，維持 LRU 順序
+            return dict(entry['criteria'])
+    return None
+
+def store_ai_criteria(key: str, criteria: dict):
+    """將 AI 解析結果寫入快取，並同步更新快取檔案"""
+    with criteria_cache_lock:
+        criteria_cache[key] = {'time': time.time(), 'criteria': criteria}
+        while len(criteria_cache) > CRITERIA_CACHE_SIZE:
+            del criteria_cache[next(iter(criteria_cache))]
+
+    # 寫檔不佔用 criteria_cache_lock，快取命中不必等待磁碟 I/O；
+    # 先寫到暫存檔再替換，寫到一半中斷也不會損毀原本的快取檔案
+    with criteria_cache_file_lock:
+        with criteria_cache_lock:
+            snapshot = dict(criteria_cache)
+        tmp_file = CRITERIA_CACHE_FILE + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(CRITERIA_CACHE_FILE), exist_ok=True)
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_file, CRITERIA_CACHE_FILE)
+        except OSError as e:
+            print(f"🔴 無法寫入快取檔案: {e}")
+
+def request_ai_criteria(user_requirement: str) -> dict:
     """呼叫 AI 模型將使用者需求轉換為 JSON 格式的 SQL 查詢"""
     prompt_for_ai = f"""Please help me convert the user's requirement: "{user_requirement}" into a structured JSON format.
 The JSON should contain these keys: [location, distance, age, size, price, labels_to_exclude, labels_to_include].
@@ -57,9 +216,8 @@ The JSON should contain these keys: [location, distance, age, size, price, label
 Please answer with only the JSON object, without any additional text or markdown.
 If a field is not specified, set its value to null.
 """
-    client = InferenceClient(model=AI_MODEL, token=API_TOKEN)
     try:
-        response = client.chat_completion(
+        response = ai_client.chat_completion(
             messages=[{"role": "user", "content": prompt_for_ai}],
             max_tokens=500,
             temperature=0.1, # 降低隨機性以獲得更穩定的 JSON 輸出
@@ -67,12 +225,12 @@ If a field is not specified, set its value to null.
         response_text = response.choices[0].message.content or ""
         
         # 清理 AI 回應，只留下 JSON 部分
-        json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-        if not json_match:
+        json_text = extract_json(response_text)
+        if json_text is None:
             print("🔴 AI 未回傳有效的 JSON 格式。")
             return {}
             
-        return json.loads(json_match.group(0))
+        return json.loads(json_text)
 
     except HfHubHTTPError as e:
         print(f"🔴 Hugging Face API 錯誤: {e.response.text}")
@@ -81,71 +239,130 @@ If a field is not specified, set its value to null.
         print(f"🔴 未預期的錯誤: {e}")
         return {}
 
-def haversine(lat1, lon1, lat2, lon2):
-    """計算兩個經緯度座標之間的距離（公里）"""
+def extract_json(text):
+    """由左至右掃描一次，回傳第一個括號平衡的 {...} 區段，找不到則回傳 None"""
+    start = text.find('{')
+    if start < 0:
+        return None
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            # 字串內的括號不計入層數
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+def distances_from(lat, lon, indices):
+    """計算中心點到指定房屋的距離（公里），使用預先算好的房屋弧度與 cos(緯度)"""
+    R = 6371.0  # 地球半徑（公里）
+    lat0_rad, lon0_rad = radians(lat), radians(lon)
+    a = (np.sin((_house_lat_rad[indices] - lat0_rad) / 2)**2
+         + _house_coslat[indices] * cos(lat0_rad) * np.sin((_house_lon_rad[indices] - lon0_rad) / 2)**2)
+    return 2 * R * np.arcsin(np.sqrt(a))
+
+def houses_in_lat_band(lat, max_dist) -> np.ndarray:
+    """回傳緯度差在 max_dist 公里內的候選房屋索引（依原始資料順序）"""
     R = 6371.0  # 地球半徑（公里）
-    lat1_rad, lon1_rad = radians(lat1), radians(lon1)
-    lat2_rad, lon2_rad = radians(lat2), radians(lon2)
-    dlon = lon2_rad - lon1_rad
-    dlat = lat2_rad - lat1_rad
-    a = sin(dlat / 2)**2 + cos(lat1_rad) * cos(lat2_rad) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    return R * c
-
-def evaluate_sql_condition(value, condition_str):
-    """評估一個簡單的 SQL-like 條件"""
+    # 球面距離不會小於緯度差對應的弧長，用二分搜尋即可取出不會漏掉的候選房屋
+    lat0_rad = radians(lat)
+    # 房屋緯度與中心點在 float32 下各有約 3e-8 弧度的捨入誤差，額外保留 1e-6 弧度（約 6 公尺）
+    # 的絕對餘裕，確保不會漏掉 distances_from 會接受的房屋；實際距離之後仍會精確判斷
+    band = max_dist / R + 1e-6
+    lo = np.searchsorted(_sorted_lat_rad, lat0_rad - band, side='left')
+    hi = np.searchsorted(_sorted_lat_rad, lat0_rad + band, side='right')
+    return np.sort(_lat_order[lo:hi])
+
+def parse_sql_condition(condition_str):
+    """解析一個簡單的 SQL-like 條件，回傳 (比較函式, 門檻值)；無法解析時回傳 None 表示忽略此條件"""
     if not condition_str or not isinstance(condition_str, str):
-        return True
+        return None
+    match = SQL_CONDITION_RE.match(condition_str)
+    if not match or match.group(1) not in SQL_OPERATORS:
+        return None
     try:
-        # 為了安全，只允許簡單的比較
-        match = re.match(r'^\w+\s*([<>=!]+)\s*([\d\.]+)$', condition_str.replace("price", "value").replace("age", "value").replace("size", "value"))
-        if not match: return True
-        
-        operator = match.group(1)
-        condition_value = float(match.group(2))
-        
-        if operator == '<=': return value <= condition_value
-        if operator == '>=': return value >= condition_value
-        if operator == '<': return value < condition_value
-        if operator == '>': return value > condition_value
-        if operator == '=': return value == condition_value
-        if operator == '!=': return value != condition_value
-        return True
-    except:
-        return True # 如果條件解析失敗，則忽略此條件
+        return SQL_OPERATORS[match.group(1)], float(match.group(2))
+    except ValueError:
+        return None # 如果條件解析失敗，則忽略此條件
+
+def filter_house_indices(criteria: dict) -> np.ndarray:
+    """根據 AI 解析出的條件篩選房屋，回傳符合條件的房屋索引（依原始資料順序）"""
+    indices = np.arange(len(house_data))
+
+    # 篩選順序由便宜到昂貴：緯度範圍 -> 價格、年齡、大小 -> 標籤 -> 實際距離
+    use_distance = bool(criteria.get('location') and criteria.get('distance'))
+    if use_distance:
+        center_lat, center_lon = criteria['location']
+        max_dist = criteria['distance']
+        indices = houses_in_lat_band(center_lat, max_dist)
+
+    # 1. 價格、年齡、大小篩選
+    for field, column in (('price', house_price), ('age', house_age), ('size', house_size)):
+        condition = parse_sql_condition(criteria.get(field))
+        if condition:
+            compare, threshold = condition
+            indices = indices[compare(column[indices], threshold)]
+
+    # 2. 標籤篩選
+    exclude_labels = criteria.get('labels_to_exclude')
+    if exclude_labels and not label_index.keys().isdisjoint(exclude_labels):
+        exc_cols = [label_index[l] for l in exclude_labels if l in label_index]
+        indices = indices[~house_label_matrix[np.ix_(indices, exc_cols)].any(axis=1)]
+    if criteria.get('labels_to_include'):
+        include_labels = criteria['labels_to_include']
+        inc_cols = [label_index[l] for l in include_labels if l in label_index]
+        if any(l not in label_index for l in include_labels):
+            # 有任何一個標籤沒有房屋具備，就不可能全部符合
+            indices = indices[:0]
+        else:
+            indices = indices[house_label_matrix[np.ix_(indices, inc_cols)].all(axis=1)]
+
+    # 3. 距離篩選：只對前面留下來的房屋計算 haversine
+    if use_distance:
+        indices = indices[distances_from(center_lat, center_lon, indices) <= max_dist]
+
+    return indices
 
 def filter_houses(criteria: dict) -> list:
     """根據 AI 解析出的條件篩選房屋"""
     if not house_data:
         return []
+    return [house_data[i] for i in filter_house_indices(criteria)[:10]] # 回傳前 10 筆
 
-    filtered = house_data
+def format_house(house: dict) -> str:
+    """將一筆房屋資料整理成 Markdown 格式的介紹"""
+    return (
+        f"🏠 **{house['name']}**\n"
+        f"- 地址: {house['address']}\n"
+        f"- 價格: {house['price']/10000:,.0f} 萬\n"
+        f"- 坪數: {house['size']} 坪\n"
+        f"- 格局: {house['bedroom']}房 / {house['living_room']}廳 / {house['bathroom']}衛\n"
+        f"- 連結: [點此查看]({house['link']})\n---\n"
+    )
 
-    # 1. 地點和距離篩選
-    if criteria.get('location') and criteria.get('distance'):
-        center_lat, center_lon = criteria['location']
-        max_dist = criteria['distance']
-        filtered = [h for h in filtered if haversine(center_lat, center_lon, h['latitude'], h['longitude']) <= max_dist]
-
-    # 2. 價格、年齡、大小篩選
-    if criteria.get('price'):
-        filtered = [h for h in filtered if evaluate_sql_condition(h['price'], criteria['price'])]
-    if criteria.get('age'):
-        filtered = [h for h in filtered if evaluate_sql_condition(h['age'], criteria['age'])]
-    if criteria.get('size'):
-        filtered = [h for h in filtered if evaluate_sql_condition(h['size'], criteria['size'])]
-
-    # 3. 標籤篩選
-    if criteria.get('labels_to_exclude'):
-        exclude_labels = set(criteria['labels_to_exclude'])
-        filtered = [h for h in filtered if not exclude_labels.intersection(set(h.get('label', [])))]
-    if criteria.get('labels_to_include'):
-        include_labels = set(criteria['labels_to_include'])
-        filtered = [h for h in filtered if include_labels.issubset(set(h.get('label', [])))]
+# --- Flask 路由 ---
 
-    return filtered[:10] # 回傳前 10 筆
+def json_response(payload, status=200):
+    """以 orjson 序列化回應內容，取代 jsonify"""
+    return app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
 
-# --- Flask 路由 ---
+def sse_event(payload) -> bytes:
+    """將資料包成一則 Server-Sent Event"""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
 
 @app.route('/')
 def index():
@@ -154,47 +371,55 @@ def index():
 
 @app.route('/chat', methods=['POST'])
 def chat():
-    """處理聊天訊息"""
-    user_message = request.json.get('message')
+    """處理聊天訊息，以 Server-Sent Events 逐步回傳結果"""
+    payload = request.get_json(silent=True)
+    user_message = payload.get('message') if isinstance(payload, dict) else None
+    user_message = user_message.translate(CONTROL_CHARS).strip() if isinstance(user_message, str) else None
     if not user_message:
-        return jsonify({"error": "沒有收到訊息"}), 400
+        return json_response({"error": "沒有收到訊息"}, 400)
+    if len(user_message) > MAX_MESSAGE_LENGTH:
+        return json_response({"error": f"請提供 {MAX_MESSAGE_LENGTH} 字以內的需求。"}, 400)
 
     print(f"💬 使用者需求: {user_message}")
+    return app.response_class(chat_events(user_message), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-    # 步驟 1: 呼叫 AI 取得篩選條件
-    criteria = get_ai_criteria(user_message)
-    print(f"🤖 AI 解析結果: {criteria}")
+def chat_events(user_message: str):
+    """依序產生回覆事件：先通知前端正在思考，再逐筆送出房屋資訊；前端將 reply 依序串接"""
+    yield sse_event({"stage": "thinking"})
 
-    if not criteria:
-        return jsonify({"reply": "抱歉，我無法理解您的需求，請換個方式說說看？"})
+    try:
+        # 步驟 1: 呼叫 AI 取得篩選條件
+        criteria = get_ai_criteria(user_message)
+        print(f"🤖 AI 解析結果: {criteria}")
 
-    # 步驟 2: 根據條件篩選房屋
-    results = filter_houses(criteria)
-    print(f"🔍 找到 {len(results)} 筆符合條件的房屋。")
+        if not criteria:
+            yield sse_event({"reply": "抱歉，我無法理解您的需求，請換個方式說說看？"})
+            return
 
-    # 步驟 3: 組合回覆訊息
-    if not results:
-        reply_message = "很抱歉，目前找不到完全符合您條件的房屋。您可以試著放寬一些條件，例如預算或通勤距離。"
-    else:
-        reply_message = f"為您找到 {len(results)} 筆可能符合需求的房屋：\n\n"
-        for house in results:
-            reply_message += (
-                f"🏠 **{house['name']}**\n"
-                f"- 地址: {house['address']}\n"
-                f"- 價格: {house['price']/10000:,.0f} 萬\n"
-                f"- 坪數: {house['size']} 坪\n"
-                f"- 格局: {house['bedroom']}房 / {house['living_room']}廳 / {house['bathroom']}衛\n"
-                f"- 連結: [點此查看]({house['link']})\n---\n"
-            )
+        # 步驟 2: 根據條件篩選房屋
+        yield sse_event({"stage": "filter"})
+        results = filter_houses(criteria)
+        print(f"🔍 找到 {len(results)} 筆符合條件的房屋。")
 
-    return jsonify({"reply": reply_message})
+        # 步驟 3: 逐筆送出回覆訊息
+        if not results:
+            yield sse_event({"reply": "很抱歉，目前找不到完全符合您條件的房屋。您可以試著放寬一些條件，例如預算或通勤距離。"})
+            return
+        yield sse_event({"reply": f"為您找到 {len(results)} 筆可能符合需求的房屋：\n\n"})
+        for house in results:
+            yield sse_event({"reply": format_house(house)})
+    except Exception as e:
+        # 回應標頭已送出，無法再改狀態碼，改以最後一則事件告知錯誤
+        print(f"🔴 處理聊天訊息時發生錯誤: {e}")
+        yield sse_event({"reply": "抱歉，處理您的需求時發生錯誤，請換個方式說說看？"})
 
 def run_server():
     """在背景執行緒中執行 Flask 伺服器"""
     # 使用 waitress 作為生產環境的 WSGI 伺服器，比 Flask 內建的更穩定
     from waitress import serve
     print("伺服器已啟動於 http://127.0.0.1:8080")
-    serve(app, host='0.0.0.0', port=8080)
+    serve(app, host='0.0.0.0', port=8080, threads=SERVER_THREADS)
 
 if __name__ == '__main__':
     # 步驟 1: 在背景執行緒中啟動 Flask 伺服器
@@ -1,7 +1,89 @@
+import dbm
+import os
+import pickle
+import re
+import shelve
+import time
 import requests
 from collections import Counter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 OVERPASS_API_URL = "https://overpass-api.de/api/interpreter"
+OVERPASS_CACHE_FILE = os.path.expanduser("~/.cache/overpass")
+OVERPASS_CACHE_TTL = 7 * 24 * 60 * 60  # 查詢結果保留 7 天
+OVERPASS_CACHE_SIZE = 512  # 快取筆數上限，超過時先刪過期、再刪最舊的
+# 快取檔被鎖定、損毀或無法寫入時會丟出的例外；發生時一律當作沒有快取
+OVERPASS_CACHE_ERRORS = (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError, *dbm.error)
+
+# 共用連線（keep-alive），重複查詢時不必再做 TCP/TLS 握手
+_session = requests.Session()
+_session.headers.update({"Accept-Encoding": "gzip, deflate"})
+# Overpass 查詢只讀取資料，POST 重試是安全的
+_retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 502, 503, 504),
+               allowed_methods=frozenset({"GET", "POST"}))
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=_retry))
+
+def read_overpass_cache(cache_key):
+    """讀取快取的設施數量，沒有、過期或讀取失敗時回傳 None（過期的項目順便刪除）"""
+    try:
+        os.makedirs(os.path.dirname(OVERPASS_CACHE_FILE), exist_ok=True)
+        with shelve.open(OVERPASS_CACHE_FILE) as cache:
+            entry = cache.get(cache_key)
+            if entry is None:
+                return None
+            saved_at, counts = entry
+            if time.time() - saved_at >= OVERPASS_CACHE_TTL:
+                del cache[cache_key]
+                return None
+            return Counter(counts)
+    except OVERPASS_CACHE_ERRORS as e:
+        print(f"讀取快取失敗，改為重新查詢: {e}")
+        return None
+
+def write_overpass_cache(cache_key, counts):
+    """寫入快取；筆數超過上限時先移除過期項目，再移除最舊的項目"""
+    try:
+        with shelve.open(OVERPASS_CACHE_FILE) as cache:
+            cache[cache_key] = (time.time(), dict(counts))
+            if len(cache) > OVERPASS_CACHE_SIZE:
+                now = time.time()
+                saved_times = {key: cache[key][0] for key in cache.keys()}
+                expired = [key for key, saved_at in saved_times.items() if now - saved_at >= OVERPASS_CACHE_TTL]
+                remaining = sorted((key for key in saved_times if key not in expired), key=saved_times.get)
+                excess = max(0, len(remaining) - OVERPASS_CACHE_SIZE)
+                for key in expired + remaining[:excess]:
+                    del cache[key]
+    except OVERPASS_CACHE_ERRORS as e:
+        print(f"寫入快取失敗: {e}")
+
+# 三鐵車站的判斷規則，依優先順序排列（同時符合時以前面的為準）
+STATION_PATTERNS = [
+    ("mrt_station", re.compile("捷運")),
+    ("tra_station", re.compile("臺灣鐵路|台鐵")),
+    ("hsr_station", re.compile("台灣高速鐵路|高鐵")),
+]
+
+def classify_station(tags):
+    """依 network / operator 判斷車站種類，不是三鐵車站則回傳 None"""
+    text = tags.get("network", "") + "\x00" + tags.get("operator", "")
+    for station_type, pattern in STATION_PATTERNS:
+        if pattern.search(text):
+            return station_type
+    return None
+
+def classify_element(tags):
+    """回傳一個 OSM 元素的設施標籤：三鐵車站優先，否則取一般設施類別"""
+    station_type = classify_station(tags)
+    if station_type:
+        return station_type
+    # 如果不是車站，再判斷是否為其他一般設施
+    return (
+        tags.get("amenity") or 
+        tags.get("shop") or 
+        tags.get("leisure") or 
+        tags.get("highway")
+    )
 
 # 預設搜尋半徑為 1000 公尺 (1公里)
 def find_nearby_amenities_with_counts(lat, lon, radius_meters=1000):
@@ -30,43 +112,23 @@ def find_nearby_amenities_with_counts(lat, lon, radius_meters=1000):
     out body;
     """
     
+    # 相同座標與半徑的查詢先看快取，避免重複呼叫 Overpass API
+    cache_key = f"{round(lat, 4)}_{round(lon, 4)}_{radius_meters}"
+    cached_counts = read_overpass_cache(cache_key)
+    if cached_counts is not None:
+        print(f"--- 使用快取的查詢結果 ({cache_key}) ---")
+        return cached_counts
+
     print(f"--- 正在以 {radius_meters} 公尺為半徑，發送包含三鐵的查詢 ---")
     
     try:
-        response = requests.post(OVERPASS_API_URL, data=query_template.encode('utf-8'), timeout=30)
+        response = _session.post(OVERPASS_API_URL, data=query_template.encode('utf-8'), timeout=30)
         response.raise_for_status()
         data = response.json()
         
-        all_found_tags = []
-        for element in data.get("elements", []):
-            tags = element.get("tags", {})
-            
-            network = tags.get("network", "")
-            operator = tags.get("operator", "")
-            
-            is_station = False
-            if "捷運" in network or "捷運" in operator:
-                all_found_tags.append("mrt_station")
-                is_station = True
-            elif "臺灣鐵路" in network or "台鐵" in network or "臺灣鐵路" in operator or "台鐵" in operator:
-                all_found_tags.append("tra_station")
-                is_station = True
-            elif "台灣高速鐵路" in operator or "高鐵" in operator or "台灣高速鐵路" in network or "高鐵" in network:
-                all_found_tags.append("hsr_station")
-                is_station = True
-            
-            # 如果不是車站，再判斷是否為其他一般設施
-            if not is_station:
-                tag_value = (
-                    tags.get("amenity") or 
-                    tags.get("shop") or 
-                    tags.get("leisure") or 
-                    tags.get("highway")
-                )
-                if tag_value:
-                    all_found_tags.append(tag_value)
-
-        return Counter(all_found_tags)
+        # 一次走過所有元素並直接計數，不另外建立標籤串列
+        tag_values = (classify_element(e.get("tags", {})) for e in data.get("elements", []))
+        counts = Counter(tag for tag in tag_values if tag)
         
     except requests.exceptions.RequestException as e:
         print(f"查詢 OSM 時發生網路錯誤: {e}")
@@ -75,6 +137,10 @@ def find_nearby_amenities_with_counts(lat, lon, radius_meters=1000):
         print(f"處理資料時發生未知錯誤: {e}")
         return Counter()
 
+    # 寫入快取失敗不影響已取得的查詢結果
+    write_overpass_cache(cache_key, counts)
+    return counts
+
 # --- 測試 ---
 # 這次我們用「台北車站」附近的座標來測試，這樣才能同時找到三鐵
 property_lat = 25.0479